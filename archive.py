@@ -1,7 +1,7 @@
 # archive.py
 # Cubeflix Binary Format Archives
 
-import cbf, os
+import cbf, io, os
 
 # Compress a CBF archive.
 def compress(path, output):
@@ -12,51 +12,100 @@ def compress(path, output):
     with open(output, 'wb') as f:
         cbf.dump(dataset, f)
 
-# Recursively load a path into a dataset.
-def _load_path(path):
+# Compress a list of (path, name) pairs into a CBF archive.
+def compress_items(items, output):
+    # Load the dataset.
     dataset = {}
-    
-    # Iterate over the path.
-    for item in os.listdir(path):
-        item_path = os.path.join(path, item)
-        if os.path.isfile(item_path):
+    for path, name in items:
+        # Nested items, like "documentation/sub", go in nested datasets.
+        *parents, name = name.split('/')
+        parent = dataset
+        for i in parents:
+            parent = parent.setdefault(i, {})
+
+        if os.path.isfile(path):
             # File.
-            dataset[item] = cbf.FileWritableBlob(item_path)
+            parent[name] = cbf.FileWritableBlob(path)
         else:
             # Folder.
-            dataset[item] = _load_path(item_path)
+            parent[name] = _load_path(path)
+
+    # Write the file.
+    with open(output, 'wb') as f:
+        cbf.dump(dataset, f)
+
+# Recursively load a path into a dataset.
+def _load_path(path):
+    dataset = {}
+    
+    # Iterate over the path. The directory entries cache the file type (and 
+    # on Windows, the size), saving a stat call per item.
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file():
+                # File.
+                dataset[entry.name] = cbf.FileWritableBlob(entry.path, entry.stat().st_size)
+            else:
+                # Folder.
+                dataset[entry.name] = _load_path(entry.path)
 
     return dataset
 
-# Extract a CBF archive.
-def extract(path, output, chunk_size=65536):
+# Extract a CBF archive. The chunk_size parameter is only accepted for 
+# compatibility. Loaded blobs are always backed by the memory mapped or read 
+# in archive, so they are written out in one piece.
+def extract(path, output, chunk_size=None):
     # Load the file.
     with open(path, 'rb') as f:
-        dataset = cbf.load(f)
+        # The archive is read once from start to end.
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        dataset = cbf.load(f, sequential=True)
 
         # Extract the path.
-        _extract_path(dataset, output, chunk_size)
+        _extract_path(dataset, output)
         
-# Recursively extract a path dataset.
-def _extract_path(dataset, path, chunk_size):
-    # Create the directory.
-    os.mkdir(path)
-
-    # Iterate over each item.
-    for key, val in dataset.items():
-        if isinstance(val, cbf.ReadableBlob):
-            # File.
-            with open(os.path.join(path, key), 'wb') as f:
-                i = 0
-                while i < val.size:
-                    amount_to_write = chunk_size if i + chunk_size <= val.size else (val.size - i)
-                    f.write(val.read(amount_to_write, i))
-                    i += amount_to_write
-        elif isinstance(val, dict):
-            # Folder.
-            _extract_path(val, os.path.join(path, key), chunk_size)
-        else:
-            raise cbf.InvalidCBFFileError("invalid cbf archive")
+# Extract a path dataset. Folders are kept on a stack instead of recursing, 
+# so deep archives don't hit the recursion limit.
+def _extract_path(dataset, path):
+    stack = [(dataset, path)]
+    while stack:
+        dataset, path = stack.pop()
+
+        # Create the directory.
+        os.mkdir(path)
+
+        # Iterate over each item.
+        for key, val in dataset.items():
+            if isinstance(val, cbf.ReadableBlob):
+                # File.
+                with open(os.path.join(path, key), 'wb') as f:
+                    _copy_blob(val, f)
+            elif isinstance(val, dict):
+                # Folder.
+                stack.append((val, os.path.join(path, key)))
+            else:
+                raise cbf.InvalidCBFFileError("invalid cbf archive")
+
+# Copy the contents of a readable blob into an output file. Uses sendfile to
+# keep the data inside the kernel when both ends are real files, otherwise 
+# falls back to writing from the memory mapped (or read in) archive.
+def _copy_blob(blob, file):
+    try:
+        blob.sendfile_to(file.fileno())
+        return
+    except (AttributeError, io.UnsupportedOperation):
+        pass
+
+    if blob.buffer is None:
+        # Blobs made by hand may not have a buffer.
+        file.write(blob.read_all())
+        return
+
+    # Write the blob straight out of the archive, without copying it.
+    with memoryview(blob.buffer) as view:
+        file.write(view[blob.location:blob.location + blob.size])
 
 def main():
     import argparse
@@ -3,7 +3,7 @@
 
 """The Cubeflix Binary Format (CBF)."""
 
-import io, struct, os, shutil
+import io, struct, os, mmap
 
 class WritableBlob:
 
@@ -22,31 +22,70 @@ class FileWritableBlob(WritableBlob):
 
     length = NotImplemented
 
-    def __init__(self, path):
+    def __init__(self, path, size=None):
         
-        """Create the file writable blob."""
+        """Create the file writable blob. If `size` is None, the size of the
+           file is looked up."""
 
         self.path = path
-        self.length = os.path.getsize(path)
+        self.length = os.path.getsize(path) if size is None else size
 
     def dump(self, file):
 
-        """Write the file to the given file."""
+        """Write the file to the given file. If `file` is a file on disk, the
+           data is copied with sendfile, without passing through Python."""
 
         with open(self.path, 'rb') as ourfile:
-            shutil.copyfileobj(ourfile, file)
+            # The file is read once from start to end.
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(ourfile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            out_fd = _disk_fileno(file)
+            if out_fd is not None and hasattr(os, 'sendfile'):
+                # Flush anything buffered, so the blob lands after it. This is
+                # a no-op when called from dump, which flushes up front.
+                file.flush()
+
+                offset = 0
+                remaining = self.length
+                try:
+                    while remaining > 0:
+                        sent = os.sendfile(out_fd, ourfile.fileno(), offset, remaining)
+                        if sent == 0:
+                            raise SizeError(f"file {self.path} changed size")
+                        offset += sent
+                        remaining -= sent
+                    return
+                except OSError:
+                    # Sendfile is unsupported for these files. Fall back to a
+                    # regular copy if nothing has been written yet.
+                    if offset != 0:
+                        raise
+
+            # Copy the file through a reusable buffer.
+            buffer = memoryview(bytearray(COPY_BUFSIZE))
+            remaining = self.length
+            while remaining > 0:
+                n = ourfile.readinto(buffer[:min(COPY_BUFSIZE, remaining)])
+                if not n:
+                    raise SizeError(f"file {self.path} changed size")
+                file.write(buffer[:n])
+                remaining -= n
 
 class ReadableBlob:
 
     """A readable blob object."""
 
-    def __init__(self, file, location, size):
+    def __init__(self, file, location, size, buffer=None):
 
-        """Create the readable blob object."""
+        """Create the readable blob object. If `buffer` is not None, it should
+           be a memory map or the contents of the file, which reads are served
+           from."""
 
         self.file = file
         self.location = location
         self.size = size
+        self.buffer = buffer
     
     def read(self, n, offset=0):
 
@@ -55,6 +94,9 @@ class ReadableBlob:
         if offset + n > self.size:
             raise EOFError("end of blob")
 
+        if self.buffer is not None:
+            return self.buffer[self.location + offset:self.location + offset + n]
+
         self.file.seek(self.location + offset)
         return self.file.read(n)
 
@@ -62,9 +104,41 @@ class ReadableBlob:
 
         """Read the entire blob."""
 
+        if self.buffer is not None:
+            return self.buffer[self.location:self.location + self.size]
+
         self.file.seek(self.location)
         return self.file.read(self.size)
 
+    def sendfile_to(self, out_fd):
+
+        """Copy the entire blob to the file descriptor `out_fd` with sendfile,
+           without passing through Python. Raises io.UnsupportedOperation if 
+           sendfile can't be used, in which case nothing is written."""
+
+        if not hasattr(os, 'sendfile'):
+            raise io.UnsupportedOperation("sendfile is not available")
+
+        in_fd = None if self.file is None else _disk_fileno(self.file)
+        if in_fd is None:
+            raise io.UnsupportedOperation("blob file is not a file on disk")
+
+        offset = self.location
+        remaining = self.size
+        try:
+            while remaining > 0:
+                sent = os.sendfile(out_fd, in_fd, offset, remaining)
+                if sent == 0:
+                    raise EOFError("end of blob")
+                offset += sent
+                remaining -= sent
+        except OSError as e:
+            # Sendfile is unsupported for these files, if the first call 
+            # failed.
+            if remaining == self.size:
+                raise io.UnsupportedOperation(f"sendfile failed: {e}")
+            raise
+
 class SizeError(Exception):
     pass
 
@@ -73,6 +147,7 @@ class InvalidCBFFileError(Exception):
 
 CBF_VERSION = 'A'
 CBF_HEADER = 'CB' + CBF_VERSION
+_HEADER = CBF_HEADER.encode('ascii')
 
 # Data type values.
 TYPE_NONE = 0x00
@@ -89,32 +164,97 @@ VALID_TYPES = (type(None), WritableBlob, dict, str, int, float, bytes, bool)
 
 MAX_KEY_LEN = 65535
 
+# Precompiled structs for the fixed size fields.
+_U16 = struct.Struct('<H')
+_U64 = struct.Struct('<Q')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+_BLOB = struct.Struct('<QQ')
+
+# The buffer size used when copying blobs without sendfile. Larger than the
+# 64 KiB shutil uses on POSIX (Windows already uses 1 MiB), so large files 
+# take fewer system calls.
+COPY_BUFSIZE = 1024 * 1024
+
+# Get the file descriptor of a file on disk, or None if `file` isn't one. 
+# Wrapper streams such as GzipFile have a file descriptor too, but it belongs
+# to the file they wrap, so writing to it directly would bypass the wrapper.
+def _disk_fileno(file):
+    if isinstance(file, (io.BufferedReader, io.BufferedWriter, io.BufferedRandom)):
+        file = file.raw
+    if not isinstance(file, io.FileIO):
+        return None
+
+    return file.fileno()
+
 # Dump a CBF dataset to a file.
 def dump(dataset, file):
 
-    """Dump a CBF dataset to a file."""
+    """Dump a CBF dataset to a file. `file` can be any writable file object, 
+       but file blobs are only copied in the kernel if it is a file on 
+       disk."""
 
     if not isinstance(dataset, dict):
         raise TypeError(f"dump requires a dictionary object as dataset argument, not {type(dataset)}")
 
-    if not isinstance(file, io.BufferedWriter):
-        raise TypeError(f"dump requires a buffered writer as file argument, not {type(file)}")
+    if not hasattr(file, 'write'):
+        raise TypeError(f"dump requires a writable file as file argument, not {type(file)}")
+
+    # Raw files may write short, so write through a buffer. The buffer is 
+    # flushed and detached afterwards, leaving the raw file open.
+    if isinstance(file, io.RawIOBase):
+        writer = io.BufferedWriter(file, COPY_BUFSIZE)
+        try:
+            dump(dataset, writer)
+        finally:
+            writer.detach()
+        return
 
     # Calculate the position of the binary section. Length of the header plus 
-    # the length of the dataset.
-    binary_starting_offset = 3 + _calculate_block_size(dataset)
+    # the length of the dataset. This also collects the blobs in the order 
+    # they will be written.
+    blobs = []
+    binary_starting_offset = 3 + _calculate_block_size(dataset, blobs)
     
-    # Write the header.
-    file.write(CBF_HEADER.encode('ascii'))
-
-    # Write the dataset.
-    _dump_block(dataset, file, binary_starting_offset)
-
-    # Write the binary section.
-    _dump_binary(dataset, file)
-
-# Calculate the total size of a dataset block.
-def _calculate_block_size(dataset):
+    # Encode the dataset into a single buffer, and write it with the header
+    # at once.
+    buf = bytearray(binary_starting_offset - 3)
+    _encode_block(dataset, buf, 0, binary_starting_offset)
+    _write_buffers(file, [_HEADER, buf])
+
+    # Write the binary section. The metadata is flushed first, so file blobs
+    # can be copied straight to the file descriptor.
+    file.flush()
+    _dump_binary(blobs, file)
+
+# Write a list of buffers to a file. If the file is a file on disk, the 
+# buffers are written with a single gathered write, without joining them.
+def _write_buffers(file, buffers):
+    fd = _disk_fileno(file)
+    if fd is None or not hasattr(os, 'writev'):
+        for buffer in buffers:
+            file.write(buffer)
+        return
+
+    # Flush anything buffered, so the buffers land after it.
+    file.flush()
+
+    written = os.writev(fd, buffers)
+
+    # Write whatever is left after a short write.
+    for buffer in buffers:
+        if written >= len(buffer):
+            written -= len(buffer)
+            continue
+
+        view = memoryview(buffer)[written:]
+        written = 0
+        while view:
+            view = view[os.write(fd, view):]
+
+# Calculate the total size of a dataset block. Each blob in the block is 
+# appended to blobs, in the order the blobs are encoded.
+def _calculate_block_size(dataset, blobs):
     # Account for the length value.
     size = 8
     
@@ -137,14 +277,21 @@ def _calculate_block_size(dataset):
         elif isinstance(value, WritableBlob):
             # Blob type.
             size += 16
+            blobs.append(value)
         elif isinstance(value, dict):
             # Dataset type.
-            size += _calculate_block_size(value)
+            size += _calculate_block_size(value, blobs)
         elif isinstance(value, str):
             # String type.
             size += 8 + len(value.encode('utf-8'))
+        elif isinstance(value, bool):
+            # Bool type. Checked before int, since bool is a subclass of int.
+            size += 1
         elif isinstance(value, int):
-            # Int type.
+            # Int type. Ints too large for a signed value are written 
+            # unsigned.
+            if not -2 ** 63 <= value < 2 ** 64:
+                raise SizeError(f"int value of key {key} is out of range")
             size += 8
         elif isinstance(value, float):
             # Float type.
@@ -152,138 +299,217 @@ def _calculate_block_size(dataset):
         elif isinstance(value, (bytes, bytearray)):
             # Bytes type.
             size += 8 + len(value)
-        elif isinstance(value, bool):
-            # Bool type.
-            size += 1
         else:
             raise TypeError(f"value has invalid type: {type(value)}")
 
     return size
 
-# Dump a CBF dataset block to a file. The current_estimated_file_length 
-# parameter is the current estimated file length, required for calculating 
-# pointers to regions of data within the binary section. Returns the new
-# current estimated file length.
-def _dump_block(dataset, file, current_estimated_file_length):
+# Encode a CBF dataset block into a buffer at position pos. The 
+# current_estimated_file_length parameter is the current estimated file 
+# length, required for calculating pointers to regions of data within the 
+# binary section. Returns the new position and the new current estimated file
+# length.
+def _encode_block(dataset, buf, pos, current_estimated_file_length):
     # Write the length of the dataset.
-    file.write(len(dataset).to_bytes(8, 'little'))
+    _U64.pack_into(buf, pos, len(dataset))
+    pos += 8
 
     # Iterate over the dataset and write each key-value pair.
     for key, value in dataset.items():
         # Write the key.
-        file.write(len(key).to_bytes(2, 'little'))
-        file.write(key.encode('ascii'))
+        encoded_key = key.encode('ascii')
+        _U16.pack_into(buf, pos, len(encoded_key))
+        pos += 2
+        buf[pos:pos + len(encoded_key)] = encoded_key
+        pos += len(encoded_key)
 
         # Write the data value.
         if isinstance(value, type(None)):
             # None type.
-            file.write(bytes([TYPE_NONE]))
+            buf[pos] = TYPE_NONE
+            pos += 1
         elif isinstance(value, WritableBlob):
             # Blob type. We will place the blob data in the binary section, 
             # so we can predict that the location of the blob will be the
             # current estimated file length. We will then update the current
             # estimated file length for the next blob object.
-            file.write(bytes([TYPE_BLOB]))
-            file.write(current_estimated_file_length.to_bytes(8, 'little'))
-            file.write(value.length.to_bytes(8, 'little'))
+            buf[pos] = TYPE_BLOB
+            _BLOB.pack_into(buf, pos + 1, current_estimated_file_length, value.length)
+            pos += 17
             current_estimated_file_length += value.length
         elif isinstance(value, dict):
             # Dataset type.
-            file.write(bytes([TYPE_DATASET]))
-            current_estimated_file_length = _dump_block(value, file, current_estimated_file_length)
+            buf[pos] = TYPE_DATASET
+            pos, current_estimated_file_length = _encode_block(value, buf, pos + 1, current_estimated_file_length)
         elif isinstance(value, str):
-            # String type.
-            file.write(bytes([TYPE_STRING]))
-            file.write(len(value).to_bytes(8, 'little'))
-            file.write(value.encode('utf-8'))
+            # String type. The length is the length of the encoded string.
+            encoded = value.encode('utf-8')
+            buf[pos] = TYPE_STRING
+            _U64.pack_into(buf, pos + 1, len(encoded))
+            pos += 9
+            buf[pos:pos + len(encoded)] = encoded
+            pos += len(encoded)
+        elif isinstance(value, bool):
+            # Bool type. Checked before int, since bool is a subclass of int.
+            buf[pos] = TYPE_BOOL
+            buf[pos + 1] = 0xff if value else 0x00
+            pos += 2
         elif isinstance(value, int):
-            # Int type.
-            file.write(bytes([TYPE_INT]))
-            file.write(value.to_bytes(8, 'little'))
+            # Int type, or unsigned int type for ints too large to be signed.
+            if value < 2 ** 63:
+                buf[pos] = TYPE_INT
+                _I64.pack_into(buf, pos + 1, value)
+            else:
+                buf[pos] = TYPE_UINT
+                _U64.pack_into(buf, pos + 1, value)
+            pos += 9
         elif isinstance(value, float):
             # Float type.
-            file.write(bytes([TYPE_FLOAT]))
-            file.write(struct.pack('d', value))
+            buf[pos] = TYPE_FLOAT
+            _F64.pack_into(buf, pos + 1, value)
+            pos += 9
         elif isinstance(value, (bytes, bytearray)):
             # Bytes type.
-            file.write(bytes([TYPE_BYTES]))
-            file.write(len(value).to_bytes(8, 'little'))
-            file.write(value)
-        elif isinstance(value, bool):
-            # Bool type.
-            file.write(bytes([TYPE_BOOL]))
-            if value:
-                file.write(b'\xff')
-            else:
-                file.write(b'\x00')
+            buf[pos] = TYPE_BYTES
+            _U64.pack_into(buf, pos + 1, len(value))
+            pos += 9
+            buf[pos:pos + len(value)] = value
+            pos += len(value)
         else:
             raise TypeError(f"value has invalid type: {type(value)}")
 
-    return current_estimated_file_length
+    return pos, current_estimated_file_length
 
-# Dump the CBF binary section to a file. Takes a dataset and adds each blob 
-# in order.
-def _dump_binary(dataset, file):
-    # Iterate over the dataset and write all the blobs.
-    for value in dataset.values():
-        if isinstance(value, WritableBlob):
-            # Blob type. Write the blob.
-            value.dump(file)
-        elif isinstance(value, dict):
-            # Dataset type. Recursively dump the datasets contents.
-            _dump_binary(value, file)
+# Dump the CBF binary section to a file. Takes the list of blobs collected by
+# _calculate_block_size and writes each one in order.
+def _dump_binary(blobs, file):
+    for blob in blobs:
+        blob.dump(file)
 
 # Load a CBF file.
-def load(file):
-    if not isinstance(file, io.BufferedReader):
-        raise TypeError(f"load requires a buffered reader as file argument, not {type(file)}")
+def load(file, sequential=False):
+
+    """Load a CBF file. `file` can be any readable file object. If 
+       `sequential` is true, the kernel is advised that the blobs will be read
+       in order. The blobs keep a reference to `file` (and the memory map of
+       it), so it should stay open while they are being read."""
+
+    if not hasattr(file, 'read'):
+        raise TypeError(f"load requires a readable file as file argument, not {type(file)}")
+
+    # Raw files may read short, so read through a buffer. The buffer is 
+    # detached afterwards, leaving the raw file open for the blobs.
+    if isinstance(file, io.RawIOBase):
+        reader = io.BufferedReader(file, COPY_BUFSIZE)
+    else:
+        reader = file
+
+    try:
+        # Read the header.
+        header = reader.read(3)
+        if header != _HEADER:
+            raise InvalidCBFFileError('invalid header')
+
+        # Map the file into memory, so the metadata can be parsed and blobs 
+        # can be read without seeking. Files which can't be mapped are read 
+        # into memory instead. Only files on disk are mapped, since wrapper 
+        # streams such as GzipFile share the descriptor of the file they 
+        # wrap. The blobs of those don't keep a reference to the file.
+        fd = _disk_fileno(file)
+        blob_file = file if fd is not None else None
+        buffer = None
+        if fd is not None:
+            try:
+                buffer = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass
+            else:
+                if sequential and hasattr(buffer, 'madvise'):
+                    buffer.madvise(mmap.MADV_SEQUENTIAL)
 
-    # Read the header.
-    header = file.read(3)
-    if header != CBF_HEADER.encode('ascii'):
-        raise InvalidCBFFileError('invalid header')
+        if buffer is None:
+            buffer = header + reader.read()
+    finally:
+        if reader is not file:
+            reader.detach()
 
     # Read the dataset section.
-    return _load_block(file)
-
-# Load a dataset block from a file.
-def _load_block(file):
+    with memoryview(buffer) as view:
+        try:
+            block, _ = _load_block(view, 3, blob_file, buffer)
+        except (struct.error, IndexError):
+            raise InvalidCBFFileError('unexpected end of file')
+
+    return block
+
+# Load a dataset block from a buffer at position pos. Returns the block and 
+# the position after it. Nested blocks are kept on a stack instead of 
+# recursing, so deep files don't hit the recursion limit.
+def _load_block(view, pos, file, buffer):
     # Get the length of the dataset block.
-    length = int.from_bytes(file.read(8), 'little', signed=False)
+    length = _U64.unpack_from(view, pos)[0]
+    pos += 8
     
-    block = {}
+    root = {}
+
+    # Each stack entry is a block and the number of key-value pairs left to
+    # read into it.
+    stack = [[root, length]]
 
     # Read each key-value pair and reconstruct the block.
-    for _ in range(length):
+    while stack:
+        entry = stack[-1]
+        if entry[1] == 0:
+            # The block is complete, so continue with its parent.
+            stack.pop()
+            continue
+        entry[1] -= 1
+        block = entry[0]
+
         # Read the key.
-        key_len = int.from_bytes(file.read(2), 'little', signed=False)
-        key = file.read(key_len).decode('ascii')
-        value = None
+        key_len = _U16.unpack_from(view, pos)[0]
+        pos += 2
+        key = str(_slice(view, pos, key_len), 'ascii')
+        pos += key_len
 
         # Read the data type.
-        data_type = file.read(1)[0]
+        data_type = view[pos]
+        pos += 1
         if data_type == TYPE_NONE:
             value = None
         elif data_type == TYPE_BLOB:
-            location = int.from_bytes(file.read(8), 'little', signed=False)
-            size = int.from_bytes(file.read(8), 'little', signed=False)
-            value = ReadableBlob(file, location, size)
+            location, size = _BLOB.unpack_from(view, pos)
+            pos += 16
+            value = ReadableBlob(file, location, size, buffer)
         elif data_type == TYPE_DATASET:
-            value = _load_block(file)
+            # Read the nested block before the rest of this one.
+            length = _U64.unpack_from(view, pos)[0]
+            pos += 8
+            block[key] = {}
+            stack.append([block[key], length])
+            continue
         elif data_type == TYPE_STRING:
-            str_len = int.from_bytes(file.read(8), 'little', signed=False)
-            value = file.read(str_len).decode('utf-8')
+            str_len = _U64.unpack_from(view, pos)[0]
+            pos += 8
+            value = str(_slice(view, pos, str_len), 'utf-8')
+            pos += str_len
         elif data_type == TYPE_INT:
-            value = int.from_bytes(file.read(8), 'little', signed=True)
+            value = _I64.unpack_from(view, pos)[0]
+            pos += 8
         elif data_type == TYPE_UINT:
-            value = int.from_bytes(file.read(8), 'little', signed=False)
+            value = _U64.unpack_from(view, pos)[0]
+            pos += 8
         elif data_type == TYPE_FLOAT:
-            value = struct.unpack('d', file.read(8))
+            value = _F64.unpack_from(view, pos)[0]
+            pos += 8
         elif data_type == TYPE_BYTES:
-            bytes_len = int.from_bytes(file.read(8), 'little', signed=False)
-            value = file.read(bytes_len)
+            bytes_len = _U64.unpack_from(view, pos)[0]
+            pos += 8
+            value = bytes(_slice(view, pos, bytes_len))
+            pos += bytes_len
         elif data_type == TYPE_BOOL:
-            raw_val = file.read(1)[0]
+            raw_val = view[pos]
+            pos += 1
             if raw_val == 0x00:
                 value = False
             elif raw_val == 0xff:
@@ -295,4 +521,11 @@ def _load_block(file):
 
         block[key] = value
     
-    return block
\ No newline at end of file
+    return root, pos
+
+# Slice n bytes from a buffer at position pos, checking the bounds.
+def _slice(view, pos, n):
+    if pos + n > len(view):
+        raise InvalidCBFFileError('unexpected end of file')
+
+    return view[pos:pos + n]
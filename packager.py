@@ -1,32 +1,144 @@
 # packager.py
-# Cubeflix packager.
+# Cubeflix packager. Requires Python 3.8 or later, where shutil copies files in
+# the kernel and copytree walks directories with os.scandir.
 
-import tempfile, shutil, os, datetime, json
-import tarfile, zipfile
+import tempfile, shutil, os, sys, stat, datetime, json, subprocess
+import concurrent.futures, functools, threading
 import archive as cbf
-import xml.etree.cElementTree as ET
-from contextlib import contextmanager
 
 import logging
 
+# The clonefile function on macOS.
+_clonefile = None
+if sys.platform == 'darwin':
+    try:
+        import ctypes
+        _clonefile = ctypes.CDLL(None, use_errno=True).clonefile
+        _clonefile.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32)
+        _clonefile.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        _clonefile = None
+
 FORMAT_TARBALL = 'tar'
 FORMAT_TARBALL_COMPRESSED = 'tar-gz'
 FORMAT_ZIP = 'zip'
 FORMAT_CBF = 'cbf'
 FORMAT_FOLDER = 'folder'
 
+# The block buffer size for tarballs written as a stream.
+TAR_BUFSIZE = 4 * 1024 * 1024
+
+# The default gzip compression level for compressed tarballs. Favors speed 
+# over size.
+GZIP_COMPRESSLEVEL = 1
+
+# The write buffer size for zip files.
+ZIP_BUFSIZE = 4 * 1024 * 1024
+
+# The default deflate compression level for zip files. Favors speed over size.
+ZIP_COMPRESSLEVEL = 1
+
+# The most bytes cloned with a single copy_file_range call.
+CLONE_CHUNK_SIZE = 1024 * 1024 * 1024
+
+# The number of paths copied in parallel when preparing a package.
+COPY_WORKERS = 8
+
+# The declaration at the start of each manifest.
+XML_DECLARATION = b'<?xml version="1.0" encoding="utf-8"?>\n'
+
 class CubeflixPackagerException(Exception):
 
     """A Cubeflix packager exception."""
 
+@functools.lru_cache(maxsize=1024)
+def escape_xml(text, attribute=False):
+
+    """Escape text for an XML manifest, returning it encoded as UTF-8. If 
+       `attribute` is True, quotes are escaped as well. The results are 
+       cached, since the same values repeat across manifests."""
+
+    if text is None:
+        return b''
+
+    # Escaped by hand, since xml.sax.saxutils imports urllib and http.
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if attribute:
+        text = text.replace('"', '&quot;')
+    return text.encode('utf-8')
+
+def write_xml_element(buf, tag, text):
+
+    """Write an XML element with the tag `tag` and text `text` to the 
+       bytearray `buf`."""
+
+    buf += b'<' + tag + b'>' + escape_xml(text) + b'</' + tag + b'>'
+
+def clone_file(src, dest):
+
+    """Try to clone a file from `src` to `dest` without copying its data, 
+       returning True if it was cloned. Uses copy_file_range on Linux, which
+       shares the data on filesystems with reflinks, and clonefile on macOS.
+       Returns False if neither is available or supported for these files,
+       or if `src` isn't a regular file."""
+
+    # Only clone regular files. Opening a named pipe would block, while 
+    # shutil.copyfile refuses to copy one.
+    if not stat.S_ISREG(os.stat(src).st_mode):
+        return False
+
+    if _clonefile is not None:
+        return _clonefile(os.fsencode(src), os.fsencode(dest), 0) == 0
+
+    if not hasattr(os, 'copy_file_range'):
+        return False
+
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+        copied = 0
+        try:
+            while True:
+                n = os.copy_file_range(src_file.fileno(), dest_file.fileno(), CLONE_CHUNK_SIZE)
+                if n == 0:
+                    # Some filesystems return 0 without copying anything, so
+                    # if nothing was copied, let shutil copy the file instead.
+                    # This copies empty files too.
+                    return copied != 0
+                copied += n
+        except OSError:
+            # Unsupported for these files, if nothing was copied yet.
+            if copied:
+                raise
+            return False
+
+def copy_file(src, dest):
+
+    """Copy a file from `src` to `dest`, with its permission bits. The file is
+       cloned if possible, and otherwise copied with shutil.copyfile, which 
+       copies in the kernel (with sendfile on Linux) where possible."""
+
+    if not clone_file(src, dest):
+        shutil.copyfile(src, dest)
+    shutil.copymode(src, dest)
+
 def copy_path(src, dest):
 
     """Copy a path from `src` to `dest`."""
 
     if os.path.isdir(src):
-        shutil.copytree(src, dest)
+        shutil.copytree(src, dest, symlinks=False, copy_function=copy_file)
     else:
-        shutil.copy(src, dest)
+        copy_file(src, dest)
+
+def zip_path(zip_file, path, name):
+
+    """Recursively add a path to a zip file as `name`."""
+
+    zip_file.write(path, name)
+    if os.path.isdir(path):
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            zip_path(zip_file, entry.path, name + '/' + entry.name)
 
 def delete_path(path):
 
@@ -37,17 +149,15 @@ def delete_path(path):
     else:
         os.remove(path)
 
-@contextmanager
-def working_directory(path):
+def delete_old_release(path):
 
-    """A context manager to set the current working directory. From https://gist.github.com/nottrobin/3d675653244f8814838a."""
+    """Delete a previous release at `path`, logging any failure instead of 
+       raising it, since this runs after the new release is in place."""
 
-    prev_cwd = os.getcwd()
-    os.chdir(path)
     try:
-        yield
-    finally:
-        os.chdir(prev_cwd)
+        shutil.rmtree(path)
+    except OSError as e:
+        logging.warning(f"Failed to delete previous release {path}: {e}")
 
 class Project:
 
@@ -70,83 +180,95 @@ class Project:
 
         logging.info(f"Releasing project {self.name} to path {output_path}...")
 
+        # Release into a staging folder next to the output folder, which 
+        # replaces the output folder once the release is complete.
+        final_path = os.path.normpath(output_path)
+        output_path = final_path + '.new'
+
+        # Delete anything left over from an earlier release.
         if os.path.isdir(output_path):
-            # Folder exists, delete the output folder.
             shutil.rmtree(output_path)
 
         # Create the output path.
         os.mkdir(output_path)
 
-        # Release each package.
-        for package in self.packages:
-            # Release the package.
-            package.release(output_path)
+        # The project and its packages share the same timestamp.
+        timestamp = datetime.datetime.now().isoformat()
+
+        # Release each package. Packages are prepared in separate temporary
+        # folders and written to separate files, so they can be released in 
+        # parallel. Releasing is mostly I/O and compression, which release 
+        # the GIL, so threads are enough.
+        max_workers = max(1, min(len(self.packages), (os.cpu_count() or 1) * 2))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda package: package.release(output_path, timestamp, max_workers), self.packages))
 
         # Prepare the manifest file.
         logging.info(f"Writing project manifest...")
         with open(os.path.join(output_path, "MANIFEST.xml"), 'wb') as manifest_file:
-            manifest_file.write(self.create_manifest())
+            manifest_file.write(self.create_manifest(timestamp))
 
-        logging.info(f"Released project {self.name} to path {output_path}.")
+        # Swap the release into place. The previous release is moved aside 
+        # and deleted in the background, instead of before releasing. It is
+        # moved into a folder with a unique name, so it never clashes with 
+        # the previous release of an earlier call still being deleted. The 
+        # thread isn't a daemon, so the interpreter finishes deleting it 
+        # before exiting.
+        if os.path.isdir(final_path):
+            old_path = tempfile.mkdtemp(prefix=os.path.basename(final_path) + '.old-', dir=os.path.dirname(final_path) or '.')
+            os.rename(final_path, os.path.join(old_path, os.path.basename(final_path)))
+            threading.Thread(target=delete_old_release, args=(old_path,)).start()
+        os.rename(output_path, final_path)
 
-    def create_manifest(self):
+        logging.info(f"Released project {self.name} to path {final_path}.")
 
-        """Create the manifest file, returning its contents."""
+    def create_manifest(self, timestamp=None):
 
-        # Create the XML manifest.
-        tree = ET.Element("project")
-        
-        # Add the project information.
-        name = ET.Element("name")
-        name.text = self.name
-        tree.append(name)
+        """Create the manifest file, returning its contents. If `timestamp` is
+           None, the current time is used."""
 
-        description = ET.Element("description")
-        description.text = self.description
-        tree.append(description)
+        if timestamp is None:
+            timestamp = datetime.datetime.now().isoformat()
 
-        author = ET.Element("author")
-        author.text = self.author
-        tree.append(author)
-
-        license = ET.Element("license")
-        license.text = self.license
-        tree.append(license)
+        # Write the XML manifest directly, since its layout is fixed.
+        buf = bytearray(XML_DECLARATION)
+        buf += b'<project>'
+        
+        # Add the project information.
+        write_xml_element(buf, b'name', self.name)
+        write_xml_element(buf, b'description', self.description)
+        write_xml_element(buf, b'author', self.author)
+        write_xml_element(buf, b'license', self.license)
 
         # Add each package.
-        packages = ET.Element("packages")
+        buf += b'<packages>'
         for package in self.packages:
-            package_item = package.create_manifest_tree()
-            
-            # Add the format information.
-            formats = ET.Element("formats")
-            for i in package.output_formats:
-                formats.append(ET.Element("format", {"type": i}))
-            package_item.append(formats)
-
-            packages.append(package_item)
-
-        tree.append(packages)
+            package._write_manifest_fragment(buf)
+        buf += b'</packages>'
 
         # Add the timestamp.
-        timestamp = ET.Element("timestamp")
-        timestamp.text = str(datetime.datetime.now())
-        tree.append(timestamp)
+        write_xml_element(buf, b'timestamp', timestamp)
 
-        return ET.tostring(tree, encoding='utf8', method='xml')
+        buf += b'</project>'
+        return bytes(buf)
 
 class Package:
 
     """A package for a Cubeflix project."""
 
-    def __init__(self, name, path, contents, output_formats, description, version, author, pre_package=None, package_items=None):
+    def __init__(self, name, path, contents, output_formats, description, version, author, pre_package=None, package_items=None, compresslevel=GZIP_COMPRESSLEVEL, pigz_threads=None, zip_compresslevel=ZIP_COMPRESSLEVEL):
 
         """Create the package. `contents` should be a list of paths to include 
            in the package. Function `pre_package` will be called with the path 
            to the temporary package. If `package_items` is not None, it should
            be a list of paths to include in the final package. If it is None, 
            the package will include all items in the temp folder after 
-           pre-packaging."""
+           pre-packaging. `compresslevel` is the gzip compression level for 
+           compressed tarballs, which are compressed with pigz if it is 
+           installed. `pigz_threads` is the number of threads pigz uses, or 
+           None to share the CPUs between the packages being released at 
+           once. `zip_compresslevel` is the deflate 
+           compression level for zip files."""
 
         self.name = name
         self.path = path
@@ -157,159 +279,283 @@ class Package:
         self.version = version
         self.author = author
         self.package_items = package_items
-
+        self.compresslevel = compresslevel
+        self.pigz_threads = pigz_threads
+        self.zip_compresslevel = zip_compresslevel
+        self._manifest_parts = None
+        self._parallel_releases = 1
+
+        # Resolve the release function for each output format.
+        release_functions = {
+            FORMAT_TARBALL: self._release_tar,
+            FORMAT_TARBALL_COMPRESSED: functools.partial(self._release_tar, compressed=True),
+            FORMAT_ZIP: self._release_zip,
+            FORMAT_CBF: self._release_cbf,
+            FORMAT_FOLDER: self._release_folder,
+        }
+        self._release_functions = {}
         for i in self.output_formats:
-            assert i in (FORMAT_TARBALL, \
-                                      FORMAT_TARBALL_COMPRESSED, \
-                                      FORMAT_ZIP, \
-                                      FORMAT_FOLDER, \
-                                      FORMAT_CBF), \
-                                      "Invalid output format"
+            if not i in release_functions:
+                raise CubeflixPackagerException(f"Invalid output format {i}")
+            self._release_functions[i] = release_functions[i]
 
-    def release(self, output_path):
+    def release(self, output_path, timestamp=None, parallel_releases=1):
 
-        """Produce a release for the package."""
+        """Produce a release for the package. If `timestamp` is None, the 
+           current time is used as the manifest timestamp. 
+           `parallel_releases` is the number of packages being released at 
+           once, which share the CPUs when compressing with pigz."""
 
         logging.info(f"Releasing package {self.name} to path {output_path} ({self.version})...")
 
+        self._parallel_releases = parallel_releases
+
         # Create a temporary folder to prepare the package.
         with tempfile.TemporaryDirectory() as temp_folder:
-            # Copy the paths into the temporary folder.
-            logging.info(f"Copying files...")
-            for path in self.contents:
-                # Copy the path into the temporary folder.
-                basename = os.path.basename(path)
-                copy_path(os.path.join(self.path, path), os.path.join(temp_folder, basename))
-
             # Prepare the package manifest.
             logging.info(f"Writing package manifest...")
             with open(os.path.join(temp_folder, "MANIFEST.xml"), 'wb') as manifest_file:
-                manifest_file.write(self.create_manifest())
+                manifest_file.write(self.create_manifest(timestamp))
 
-            # Call the pre-package function.
             if self.pre_package:
+                # The pre-package function may modify the package, so copy the
+                # paths into the temporary folder.
+                logging.info(f"Copying files...")
+                with concurrent.futures.ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+                    list(executor.map(lambda path: self._copy_one(path, temp_folder), self.contents))
+
+                # Call the pre-package function.
                 logging.info(f"Running pre-package script...")
                 self.pre_package(temp_folder)
 
-            # Produce the releases.
-            for i in self.output_formats:
-                logging.info(f"Outputting package release (output format {i})...")
-                if i == FORMAT_TARBALL:
-                    self._release_tar(output_path, temp_folder)
-                elif i == FORMAT_TARBALL_COMPRESSED:
-                    self._release_tar_gz(output_path, temp_folder)
-                elif i == FORMAT_ZIP:
-                    self._release_zip(output_path, temp_folder)
-                elif i == FORMAT_CBF:
-                    self._release_cbf(output_path, temp_folder)
-                elif i == FORMAT_FOLDER:
-                    self._release_folder(output_path, temp_folder)
-                else:
-                    raise CubeflixPackagerException("Invalid output format")
+                # Sort the items, so the archives don't depend on the order 
+                # of the directory.
+                with os.scandir(temp_folder) as it:
+                    items = sorted((entry.path, entry.name) for entry in it)
+            else:
+                # Package the paths directly from their source, without 
+                # copying them.
+                join = os.path.join
+                basename = os.path.basename
+                items = [(join(self.path, path), basename(path)) for path in self.contents]
+                items.append((join(temp_folder, "MANIFEST.xml"), "MANIFEST.xml"))
+
+            if self.package_items:
+                # Only include the items in package_items.
+                items = self._select_package_items(items)
+
+            # Produce the releases. Each output format only reads the items 
+            # and writes its own file, so they can be produced in parallel.
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                list(executor.map(lambda i: self._release_format(i, output_path, items), self.output_formats))
             
         logging.info(f"Released package {self.name} to path {output_path} ({self.version}).")
 
+    def _copy_one(self, path, temp_folder):
+
+        """Copy a path from the package contents into the temporary folder."""
+
+        basename = os.path.basename(path)
+        copy_path(os.path.join(self.path, path), os.path.join(temp_folder, basename))
+
+    def _select_package_items(self, items):
+
+        """Select the items in package_items, in order, from the `(path, 
+           name)` pairs in `items`, followed by the manifest. Items may be 
+           nested paths inside the top-level items, like 
+           "documentation/sub"."""
+
+        top_level = {name: path for path, name in items}
+
+        selected = []
+        for item in self.package_items:
+            parts = [i for i in item.replace('\\', '/').split('/') if i not in ('', '.')]
+            if not parts or '..' in parts or not parts[0] in top_level:
+                raise CubeflixPackagerException(f"Package item {item} not found")
+
+            path = os.path.join(top_level[parts[0]], *parts[1:])
+            if not os.path.lexists(path):
+                raise CubeflixPackagerException(f"Package item {item} not found")
+            selected.append((path, '/'.join(parts)))
+
+        if not any(name == "MANIFEST.xml" for _, name in selected):
+            selected.append((top_level["MANIFEST.xml"], "MANIFEST.xml"))
+
+        return selected
+
+    def _release_format(self, output_format, output_path, items):
+
+        """Release the package in the given output format. `items` should be a
+           list of `(path, name)` pairs to include in the package."""
+
+        logging.info(f"Outputting package release (output format {output_format})...")
+        self._release_functions[output_format](output_path, items)
+
     def create_manifest_tree(self):
 
         """Create the manifest XML tree."""
 
+        # Manifests are written without ElementTree, so it is only imported 
+        # here.
+        import xml.etree.ElementTree as ET
+
         # Create the XML manifest.
         tree = ET.Element("package")
         
         # Add the package information.
-        name = ET.Element("name")
-        name.text = self.name
-        tree.append(name)
+        ET.SubElement(tree, "name").text = self.name
+        ET.SubElement(tree, "description").text = self.description
+        ET.SubElement(tree, "version").text = self.version
+        ET.SubElement(tree, "author").text = self.author
 
-        description = ET.Element("description")
-        description.text = self.description
-        tree.append(description)
+        return tree
 
-        version = ET.Element("version")
-        version.text = self.version
-        tree.append(version)
+    def create_manifest(self, timestamp=None):
 
-        author = ET.Element("author")
-        author.text = self.author
-        tree.append(author)
+        """Create the manifest file, returning its contents. If `timestamp` is
+           None, the current time is used."""
 
-        return tree
+        # Write the XML manifest directly, since its layout is fixed.
+        buf = bytearray(XML_DECLARATION)
+        self._write_manifest_fragment(buf, timestamp if timestamp is not None else datetime.datetime.now().isoformat())
 
-    def create_manifest(self):
+        return bytes(buf)
 
-        """Create the manifest file, returning its contents."""
+    def _write_manifest_fragment(self, buf, timestamp=None):
 
-        # Create the XML manifest.
-        tree = self.create_manifest_tree()
+        """Write the package element of the manifest to the bytearray `buf`.
+           The timestamp is only included if it is not None. The rest of the
+           element is the same in the package and project manifests, so it is
+           cached until the package information changes."""
 
-        # Add the timestamp.
-        timestamp = ET.Element("timestamp")
-        timestamp.text = str(datetime.datetime.now())
-        tree.append(timestamp)
+        key = (self.name, self.description, self.version, self.author, tuple(self.output_formats))
+        if self._manifest_parts is None or self._manifest_parts[0] != key:
+            # Add the package information.
+            info = bytearray()
+            write_xml_element(info, b'name', self.name)
+            write_xml_element(info, b'description', self.description)
+            write_xml_element(info, b'version', self.version)
+            write_xml_element(info, b'author', self.author)
 
-        # Add the format information.
-        formats = ET.Element("formats")
-        for i in self.output_formats:
-            formats.append(ET.Element("format", {"type": i}))
-        tree.append(formats)
+            # Add the format information.
+            formats = bytearray(b'<formats>')
+            for i in self.output_formats:
+                formats += b'<format type="' + escape_xml(i, True) + b'" />'
+            formats += b'</formats>'
 
-        return ET.tostring(tree, encoding='utf8', method='xml')
+            self._manifest_parts = (key, bytes(info), bytes(formats))
 
-    def _release_tar(self, output_path, temp_folder):
+        _, info, formats = self._manifest_parts
 
-        """Release the package in tarball format."""
+        buf += b'<package>'
+        buf += info
 
-        # Tarball the temp folder.
-        with tarfile.open(os.path.join(output_path, self.name + '.tar'), "w") as tar_file:
-            for path in ((self.package_items + ["MANIFEST.xml"]) if self.package_items else os.listdir(temp_folder)):
-                tar_file.add(os.path.join(temp_folder, path), path)
+        # Add the timestamp.
+        if timestamp is not None:
+            write_xml_element(buf, b'timestamp', timestamp)
 
-    def _release_tar_gz(self, output_path, temp_folder):
+        buf += formats
+        buf += b'</package>'
 
-        """Release the package in compressed tarball format."""
+    def _release_tar(self, output_path, items, compressed=False):
 
-        # Tarball the temp folder.
-        with tarfile.open(os.path.join(output_path, self.name + '.tar.gz'), "w:gz") as tar_file:
-            for path in ((self.package_items + ["MANIFEST.xml"]) if self.package_items else os.listdir(temp_folder)):
-                tar_file.add(os.path.join(temp_folder, path), path)
+        """Release the package in tarball format. If `compressed` is True, the
+           tarball is compressed with gzip."""
+
+        # Imported here, so projects without tarballs don't load tarfile.
+        import tarfile, gzip
+
+        tar_path = os.path.join(output_path, self.name + ('.tar.gz' if compressed else '.tar'))
+        if compressed and shutil.which('pigz'):
+            # Compress in parallel with pigz when it is installed.
+            self._release_tar_pigz(tar_path, items)
+            return
+
+        if compressed:
+            output = gzip.GzipFile(tar_path, 'wb', compresslevel=self.compresslevel)
+        else:
+            output = open(tar_path, 'wb')
+
+        # Tarball the items, storing the contents of symlinks as copying them
+        # would. The tarball is written as a stream, so it never seeks back.
+        with output, tarfile.open(fileobj=output, mode="w|", bufsize=TAR_BUFSIZE, dereference=True) as tar_file:
+            for path, name in items:
+                tar_file.add(path, name)
         
-    def _release_zip(self, output_path, temp_folder):
+    def _release_tar_pigz(self, tar_path, items):
+
+        """Release the package in compressed tarball format, piping the 
+           tarball through pigz."""
+
+        import tarfile
+
+        command = ['pigz', '-c', f'-{self.compresslevel}']
+        # By default, pigz uses a thread per CPU. The packages being released 
+        # at once each run pigz, so share the CPUs between them instead.
+        threads = self.pigz_threads or max(1, (os.cpu_count() or 1) // self._parallel_releases)
+        command += ['-p', str(threads)]
+
+        with open(tar_path, 'wb') as output:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output)
+            try:
+                # Tarball the items into pigz.
+                with tarfile.open(fileobj=process.stdin, mode="w|", bufsize=TAR_BUFSIZE, dereference=True) as tar_file:
+                    for path, name in items:
+                        tar_file.add(path, name)
+            finally:
+                process.stdin.close()
+                returncode = process.wait()
+
+        if returncode != 0:
+            raise CubeflixPackagerException(f"pigz exited with code {returncode}")
+
+    def _release_zip(self, output_path, items):
 
         """Release the package in zip file format."""
 
-        if self.package_items:
-            # Delete everything except the items in package_items.
-            for path in os.listdir(temp_folder):
-                if not path in self.package_items and path != "MANIFEST.xml":
-                    delete_path(os.path.join(temp_folder, path))
+        # Imported here, so projects without zip files don't load zipfile.
+        import zipfile
 
-        # Zip archive the temp folder.
-        shutil.make_archive(os.path.join(output_path, self.name), "zip", temp_folder, ".")
+        # Zip archive the items, writing through a large buffer.
+        with open(os.path.join(output_path, self.name + '.zip'), 'wb', buffering=ZIP_BUFSIZE) as output, \
+             zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=self.zip_compresslevel) as zip_file:
+            for path, name in items:
+                zip_path(zip_file, path, name)
 
-    def _release_cbf(self, output_path, temp_folder):
+    def _release_cbf(self, output_path, items):
 
         """Release the package in CBF file format."""
 
-        if self.package_items:
-            # Delete everything except the items in package_items.
-            for path in os.listdir(temp_folder):
-                if not path in self.package_items and path != "MANIFEST.xml":
-                    delete_path(os.path.join(temp_folder, path))
-
-        # Archive the temp folder.
-        cbf.compress(temp_folder, os.path.join(output_path, self.name + '.cbf'))
+        # Archive the items.
+        cbf.compress_items(items, os.path.join(output_path, self.name + '.cbf'))
     
-    def _release_folder(self, output_path, temp_folder):
+    def _release_folder(self, output_path, items):
 
         """Release the package as a folder."""
 
-        if self.package_items:
-            # Delete everything except the items in package_items.
-            for path in os.listdir(temp_folder):
-                if not path in self.package_items and path != "MANIFEST.xml":
-                    delete_path(os.path.join(temp_folder, path))
+        folder = os.path.join(output_path, self.name)
+        os.mkdir(folder)
+        for path, name in items:
+            # Nested items need their parent folders.
+            dest = os.path.join(folder, name)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            copy_path(path, dest)
+
+def make_pre_package(commands):
+
+    """Create a pre-package function which runs the shell commands 
+       `commands` in the package folder."""
+
+    # The commands are joined so they run in a single shell, stopping at the
+    # first one that fails.
+    command = ' && '.join(commands)
+
+    def pre_package(path):
+        # Run the commands in the package folder without changing the working 
+        # directory, which is shared between the packages being released.
+        subprocess.run(command, shell=True, cwd=path, check=True)
 
-        copy_path(temp_folder, os.path.join(output_path, self.name))
+    return pre_package
 
 def load_project(path):
 
@@ -335,11 +581,7 @@ def load_project(path):
         for package in project_json['packages']:
             # Create the pre-package function.
             if 'pre_package' in package:
-                commands = package['pre_package']
-                def pre_package(path):
-                    with working_directory(path):
-                        for command in commands:
-                            os.system(command)
+                pre_package = make_pre_package(tuple(package['pre_package']))
             else:
                 pre_package = None
 
@@ -357,11 +599,19 @@ def load_project(path):
                 package['version'] = ""
             if not 'author' in package:
                 package['author'] = ""
+            if not 'compresslevel' in package:
+                package['compresslevel'] = GZIP_COMPRESSLEVEL
+            if not 'pigz_threads' in package:
+                package['pigz_threads'] = None
+            if not 'zip_compresslevel' in package:
+                package['zip_compresslevel'] = ZIP_COMPRESSLEVEL
 
             # Create the package.
             package_obj = Package(package['name'], package['path'], package['contents'], \
                                   package['output_formats'], package['description'], package['version'], \
-                                  package['author'], pre_package=pre_package, package_items=package_items)
+                                  package['author'], pre_package=pre_package, package_items=package_items, \
+                                  compresslevel=package['compresslevel'], pigz_threads=package['pigz_threads'], \
+                                  zip_compresslevel=package['zip_compresslevel'])
             packages.append(package_obj)
 
         # Create the project.